@@ -0,0 +1,121 @@
+import base64
+import math
+import threading
+import time
+from typing import Optional, Sequence, Tuple
+
+import numpy as np
+
+DEFAULT_CAPACITY = 65536     # 記録できる行数（動作中20Hzで約55分、停止中1Hzで約18時間）
+MAX_REPLY_BYTES = 60000      # UDP 1パケットに収める応答サイズの上限
+
+
+def history_dtype(num_joints: int) -> np.dtype:
+    """応答に詰める1行分の型（時刻は t_base からの相対秒）"""
+    return np.dtype([('dt', '<f4'), ('angles', '<f4', (num_joints,)), ('pwm', '<u2', (num_joints,))])
+
+
+def resolve_time(value: float, now: Optional[float] = None) -> float:
+    """0以下の時刻は現在時刻からの相対秒として扱う (例: -10 → 10秒前)"""
+    if value <= 0:
+        return (now if now is not None else time.time()) + value
+    return value
+
+
+def decode_history(reply: str, num_joints: int) -> Tuple[float, np.ndarray]:
+    """
+    GET_JOINT_HISTORY の応答をデコード
+    応答形式: HISTORY,<行数>,<間引き>,<t_base>,<base64>
+    戻り値: (t_base, 構造化配列 dt/angles/pwm)
+    """
+    parts = reply.split(',', 4)
+    if len(parts) < 5 or parts[0] != "HISTORY":
+        raise ValueError(f"不正な履歴応答です: {reply[:40]}")
+    rows = int(parts[1])
+    t_base = float(parts[3])
+    data = np.frombuffer(base64.b64decode(parts[4]), dtype=history_dtype(num_joints))
+    if len(data) != rows:
+        raise ValueError(f"履歴の行数が一致しません: {len(data)} != {rows}")
+    return t_base, data
+
+
+class JointHistory:
+    """
+    関節角度・PWMの履歴を保持する固定長リングバッファ（事前確保したNumPy配列）
+    時刻はロック内で取得するため、バッファ内で単調増加し二分探索で範囲検索できる
+    """
+
+    def __init__(self, num_joints: int, capacity: int = DEFAULT_CAPACITY):
+        self.num_joints = num_joints
+        self.capacity = capacity
+        self.timestamps = np.zeros(capacity, dtype=np.float64)
+        self.angles = np.zeros((capacity, num_joints), dtype=np.float32)
+        self.pwm = np.zeros((capacity, num_joints), dtype=np.uint16)
+        self._head = 0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self._count
+
+    def record(self, angles: Sequence[float], pwm: Sequence[int]):
+        """現在の全関節の状態を1行追加（古い行は上書き）"""
+        with self._lock:
+            i = self._head
+            self.timestamps[i] = time.time()
+            self.angles[i] = angles
+            self.pwm[i] = pwm
+            self._head = (i + 1) % self.capacity
+            self._count = min(self._count + 1, self.capacity)
+
+    def _indices(self, t0: float, t1: float) -> np.ndarray:
+        """t0〜t1 の行番号を古い順に返す（ロック内で呼ぶ）"""
+        if self._count < self.capacity:
+            segments = [(0, self._head)]
+        else:
+            segments = [(self._head, self.capacity), (0, self._head)]
+        result = []
+        for start, end in segments:
+            ts = self.timestamps[start:end]
+            lo = start + int(np.searchsorted(ts, t0, side='left'))
+            hi = start + int(np.searchsorted(ts, t1, side='right'))
+            if hi > lo:
+                result.append(np.arange(lo, hi))
+        return np.concatenate(result) if result else np.zeros(0, dtype=np.intp)
+
+    def query(self, t0: float, t1: float, decimate: int = 1) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """t0〜t1 の (時刻, 角度, PWM) を decimate 行（記録周期）ごとに取り出す（コピーを返す）"""
+        with self._lock:
+            idx = self._indices(t0, t1)[::max(decimate, 1)]
+            return self.timestamps[idx], self.angles[idx], self.pwm[idx]
+
+    def encode(self, t0: float, t1: float, decimate: int = 1, max_bytes: int = MAX_REPLY_BYTES) -> str:
+        """
+        t0〜t1 の履歴を1パケットに収まる応答文字列にする
+        行数が多すぎる場合は間引き間隔を自動的に広げる
+        """
+        dtype = history_dtype(self.num_joints)
+        max_rows = max((max_bytes - 64) * 3 // 4 // dtype.itemsize, 1)
+        with self._lock:
+            idx = self._indices(t0, t1)
+            step = max(decimate, 1, math.ceil(len(idx) / max_rows))
+            idx = idx[::step]
+            rows = np.zeros(len(idx), dtype=dtype)
+            t_base = float(self.timestamps[idx[0]]) if len(idx) else t0
+            rows['dt'] = self.timestamps[idx] - t_base
+            rows['angles'] = self.angles[idx]
+            rows['pwm'] = self.pwm[idx]
+        payload = base64.b64encode(rows.tobytes()).decode('ascii')
+        return f"HISTORY,{len(rows)},{step},{t_base:.6f},{payload}"
+
+    def dump(self, path: str, t0: float = -math.inf, t1: float = math.inf) -> int:
+        """t0〜t1 の履歴を .npy ファイルに保存して行数を返す"""
+        dtype = np.dtype([('t', '<f8'), ('angles', '<f4', (self.num_joints,)),
+                          ('pwm', '<u2', (self.num_joints,))])
+        timestamps, angles, pwm = self.query(t0, t1)
+        rows = np.zeros(len(timestamps), dtype=dtype)
+        rows['t'] = timestamps
+        rows['angles'] = angles
+        rows['pwm'] = pwm
+        np.save(path, rows)
+        return len(rows)
@@ -0,0 +1,290 @@
+import asyncio
+import argparse
+import math
+import random
+import time
+from typing import Dict, List, Optional, Tuple
+
+# デフォルトのコマンド配分（コマンド名:比率）
+DEFAULT_MIX = "GET_JOINT_ANGLES:80,SET_ALL_JOINT_ANGLES:20"
+NUM_JOINTS = 6
+
+
+def parse_mix(mix: str) -> List[Tuple[str, float]]:
+    """'CMD:比率,CMD:比率' 形式のコマンド配分を解析"""
+    result = []
+    for item in mix.split(','):
+        name, _, weight = item.strip().partition(':')
+        result.append((name.strip(), float(weight) if weight else 1.0))
+    return result
+
+
+def build_command(name: str) -> str:
+    """コマンド名から送信文字列を生成（角度はランダム）"""
+    if name == "SET_ALL_JOINT_ANGLES":
+        angles = ",".join(f"{random.uniform(0, 180):.1f}" for _ in range(NUM_JOINTS))
+        return f"SET_ALL_JOINT_ANGLES,{angles},50.0"
+    if name == "SET_JOINT_ANGLE":
+        return f"SET_JOINT_ANGLE,{random.randrange(NUM_JOINTS)},{random.uniform(0, 180):.1f},50.0"
+    return name
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    """ソート済みリストのパーセンタイル（最近傍法）"""
+    if not sorted_values:
+        return 0.0
+    k = min(len(sorted_values) - 1, max(0, math.ceil(p / 100.0 * len(sorted_values)) - 1))
+    return sorted_values[k]
+
+
+class LoadStats:
+    """区間ごと・全体の送受信数とレイテンシを集計"""
+
+    def __init__(self):
+        self.total = self._new_window()
+        self.window = self._new_window()
+
+    @staticmethod
+    def _new_window() -> Dict:
+        return {'sent': 0, 'received': 0, 'lost': 0, 'errors': 0, 'skipped': 0, 'latencies': []}
+
+    def record(self, key: str, latency: Optional[float] = None):
+        for w in (self.total, self.window):
+            w[key] += 1
+            if latency is not None:
+                w['latencies'].append(latency)
+
+    def take_window(self) -> Dict:
+        window = self.window
+        self.window = self._new_window()
+        return window
+
+    @staticmethod
+    def format(window: Dict, elapsed: float) -> str:
+        latencies = sorted(window['latencies'])
+        done = window['received'] + window['errors'] + window['lost']
+        loss = window['lost'] / done * 100 if done else 0.0
+        throughput = window['received'] / elapsed if elapsed > 0 else 0.0
+        return (f"送信 {window['sent']:6d} | 成功 {window['received']:6d} ({throughput:8.1f} req/s) | "
+                f"損失 {loss:5.1f}% | エラー {window['errors']} | 未送信 {window['skipped']} | "
+                f"p50 {percentile(latencies, 50) * 1000:7.2f}ms "
+                f"p90 {percentile(latencies, 90) * 1000:7.2f}ms "
+                f"p99 {percentile(latencies, 99) * 1000:7.2f}ms "
+                f"max {(latencies[-1] if latencies else 0.0) * 1000:7.2f}ms")
+
+
+class _VirtualClientProtocol(asyncio.DatagramProtocol):
+    """仮想クライアント1台分のUDPエンドポイント（同時に1リクエストのみ）"""
+
+    def __init__(self):
+        self.transport = None
+        self.waiter: Optional[asyncio.Future] = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(data)
+
+    def error_received(self, exc):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_exception(exc)
+
+
+class ESP32LoadGenerator:
+    """多数の仮想クライアントでUDPプロトコルに負荷をかける"""
+
+    def __init__(self, ip_addresses: List[str], udp_port: int = 4210, clients: int = 100,
+                 mix: str = DEFAULT_MIX, mode: str = "closed", rate: float = 1000.0,
+                 think_time: float = 0.0, ramp_up: float = 0.0, duration: float = 30.0,
+                 timeout: float = 1.0, report_interval: float = 1.0):
+        self.ip_addresses = ip_addresses
+        self.udp_port = udp_port
+        self.num_clients = clients
+        self.mix = parse_mix(mix)
+        self.mode = mode
+        self.rate = rate
+        self.think_time = think_time
+        self.ramp_up = ramp_up
+        self.duration = duration
+        self.timeout = timeout
+        self.report_interval = report_interval
+
+        self.stats = LoadStats()
+        self.clients: List[Tuple[_VirtualClientProtocol, Tuple[str, int]]] = []
+        self.start_time = 0.0
+
+    def _pick_command(self) -> str:
+        names = [name for name, _ in self.mix]
+        weights = [weight for _, weight in self.mix]
+        return build_command(random.choices(names, weights=weights)[0])
+
+    def _ramp_factor(self) -> float:
+        """ランプアップ中の負荷倍率 (0〜1)"""
+        if self.ramp_up <= 0:
+            return 1.0
+        return min(1.0, (time.monotonic() - self.start_time) / self.ramp_up)
+
+    async def _open_endpoint(self) -> _VirtualClientProtocol:
+        """仮想クライアント用のUDPエンドポイントを作成"""
+        loop = asyncio.get_running_loop()
+        _, protocol = await loop.create_datagram_endpoint(
+            _VirtualClientProtocol, local_addr=('0.0.0.0', 0))
+        return protocol
+
+    async def _request(self, index: int):
+        """1リクエスト送信して応答を待つ"""
+        client, addr = self.clients[index]
+        loop = asyncio.get_running_loop()
+        client.waiter = loop.create_future()
+        command = self._pick_command() + '\n'
+        sent_at = time.perf_counter()
+        client.transport.sendto(command.encode('utf-8'), addr)
+        self.stats.record('sent')
+        try:
+            data = await asyncio.wait_for(client.waiter, self.timeout)
+            latency = time.perf_counter() - sent_at
+            if data.startswith(b"ERROR") or data.strip() == b"NG":
+                self.stats.record('errors')
+            else:
+                self.stats.record('received', latency)
+        except asyncio.TimeoutError:
+            self.stats.record('lost')
+            # 遅れて届く応答を次のリクエストの応答と取り違えないよう、送信元ポートを作り直す
+            client.transport.close()
+            self.clients[index] = (await self._open_endpoint(), addr)
+        except OSError:
+            self.stats.record('errors')
+        finally:
+            client.waiter = None
+
+    async def _closed_loop_client(self, index: int, end_time: float):
+        """クローズドループ: 応答受信後に次のリクエストを送る"""
+        if self.ramp_up > 0:
+            await asyncio.sleep(self.ramp_up * index / self.num_clients)
+        while time.monotonic() < end_time:
+            await self._request(index)
+            if self.think_time > 0:
+                await asyncio.sleep(random.expovariate(1.0 / self.think_time))
+
+    async def _open_loop(self, end_time: float):
+        """オープンループ: 応答に関係なくポアソン到着でリクエストを発生させる"""
+        idle: asyncio.Queue = asyncio.Queue()
+        for i in range(self.num_clients):
+            idle.put_nowait(i)
+
+        async def run_one(i: int):
+            try:
+                await self._request(i)
+            finally:
+                idle.put_nowait(i)
+
+        tasks = set()
+        next_at = time.monotonic()
+        while next_at < end_time:
+            next_at += random.expovariate(self.rate)
+            delay = next_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            # ランプアップ中は到着を間引いて到着率を徐々に上げる
+            if random.random() > self._ramp_factor():
+                continue
+            if idle.empty():
+                # 空きクライアントがない = 生成側が飽和
+                self.stats.record('skipped')
+                continue
+            task = asyncio.ensure_future(run_one(idle.get_nowait()))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks)
+
+    async def _reporter(self, end_time: float):
+        """一定間隔で区間統計を表示"""
+        last = time.monotonic()
+        while last < end_time:
+            await asyncio.sleep(self.report_interval)
+            now = time.monotonic()
+            window = self.stats.take_window()
+            print(f"[{now - self.start_time:6.1f}s] {LoadStats.format(window, now - last)}")
+            last = now
+
+    async def run(self):
+        """負荷試験を実行"""
+        for i in range(self.num_clients):
+            addr = (self.ip_addresses[i % len(self.ip_addresses)], self.udp_port)
+            self.clients.append((await self._open_endpoint(), addr))
+
+        print(f"負荷試験開始: クライアント {self.num_clients}, モード {self.mode}, "
+              f"配分 {self.mix}, 時間 {self.duration}秒, ランプアップ {self.ramp_up}秒")
+        print("=" * 50)
+
+        self.start_time = time.monotonic()
+        end_time = self.start_time + self.duration
+        reporter = asyncio.ensure_future(self._reporter(end_time))
+        try:
+            if self.mode == "open":
+                await self._open_loop(end_time)
+            else:
+                await asyncio.gather(*(self._closed_loop_client(i, end_time)
+                                       for i in range(self.num_clients)))
+            await reporter
+        finally:
+            reporter.cancel()
+            for protocol, _ in self.clients:
+                protocol.transport.close()
+
+        elapsed = time.monotonic() - self.start_time
+        print("=" * 50)
+        print(f"合計 ({elapsed:.1f}秒): {LoadStats.format(self.stats.total, elapsed)}")
+
+
+def _raise_fd_limit():
+    """仮想クライアント数分のソケットを開けるようファイルディスクリプタ上限を引き上げる"""
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ESP32ロボットアームUDP負荷生成ツール')
+    parser.add_argument('--ip', default='127.0.0.1', help='IPアドレス（カンマ区切りで複数指定可）')
+    parser.add_argument('--udp-port', type=int, default=4210, help='UDPポート')
+    parser.add_argument('--clients', type=int, default=100, help='仮想クライアント数')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='コマンド配分 (例: GET_JOINT_ANGLES:80,SET_ALL_JOINT_ANGLES:20)')
+    parser.add_argument('--mode', choices=['closed', 'open'], default='closed', help='クローズドループ/オープンループ')
+    parser.add_argument('--rate', type=float, default=1000.0, help='オープンループ時の到着率（req/s）')
+    parser.add_argument('--think-time', type=float, default=0.0, help='クローズドループ時の平均待ち時間（秒）')
+    parser.add_argument('--ramp-up', type=float, default=0.0, help='ランプアップ時間（秒）')
+    parser.add_argument('--duration', type=float, default=30.0, help='試験時間（秒）')
+    parser.add_argument('--timeout', type=float, default=1.0, help='応答タイムアウト（秒）')
+    parser.add_argument('--interval', type=float, default=1.0, help='統計表示間隔（秒）')
+
+    args = parser.parse_args()
+
+    _raise_fd_limit()
+    generator = ESP32LoadGenerator(
+        ip_addresses=[ip.strip() for ip in args.ip.split(",")],
+        udp_port=args.udp_port,
+        clients=args.clients,
+        mix=args.mix,
+        mode=args.mode,
+        rate=args.rate,
+        think_time=args.think_time,
+        ramp_up=args.ramp_up,
+        duration=args.duration,
+        timeout=args.timeout,
+        report_interval=args.interval
+    )
+    try:
+        asyncio.run(generator.run())
+    except KeyboardInterrupt:
+        print("\n終了します")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+import argparse
+import hashlib
+import struct
+import time
+from typing import List, Sequence, Tuple
+
+import numpy as np
+
+# --- ロボットアーム設定 ---
+# esp32_test_server_simulator.py と同じ値にすること
+# (シミュレーターはインポート時にサーバーへ接続するため、ここで再定義している)
+NUM_JOINTS = 6
+LINK_LENGTHS = [35, 160, 120, 90, 65, 36]
+
+# 角度範囲 (esp32_test_server.py の _angle_to_pwm と同じ 0〜180度でクランプされる)
+MIN_ANGLE = 0.0
+MAX_ANGLE = 180.0
+
+# --- インデックスファイル形式 ---
+# 順運動学モデルはXZ平面内（y は常に0）なので、グリッドは (x, z) の2次元で持つ
+# [ヘッダー 128バイト][uint8 ボクセル占有グリッド (x, z) C順]
+INDEX_MAGIC = b'RCHIDX03'
+# magic, ボクセルサイズ, 原点xz, 形状xz, 角度ステップ, 最大リーチ, リンク長のハッシュ
+HEADER_FORMAT = '<8sd2d2I2d16s'
+HEADER_SIZE = 128
+
+DEFAULT_INDEX_PATH = 'reachability.idx'
+DEFAULT_ANGLE_STEP = 10.0   # 度
+DEFAULT_VOXEL_SIZE = 10.0   # mm
+SWEEP_CHUNK_SIZE = 200000   # 一度に順運動学を計算する姿勢数
+
+
+def forward_kinematics_batch(angles_rad: np.ndarray, link_lengths: Sequence[float]) -> np.ndarray:
+    """
+    複数姿勢の手先位置をまとめて計算する（ベクトル化した順運動学）
+    esp32_test_server_simulator.forward_kinematics と同じ簡易モデル（XZ平面内の累積ピッチ）
+    angles_rad: (N, 関節数) のラジアン配列
+    戻り値: (N, 3) の手先座標 [mm]
+    """
+    lengths = np.asarray(link_lengths, dtype=np.float64)
+    cumulative = np.cumsum(angles_rad, axis=1)
+    positions = np.zeros((angles_rad.shape[0], 3))
+    positions[:, 0] = (lengths * np.cos(cumulative)).sum(axis=1)
+    positions[:, 2] = (lengths * np.sin(cumulative)).sum(axis=1)
+    return positions
+
+
+def link_lengths_digest(link_lengths: Sequence[float]) -> bytes:
+    """リンク長のハッシュ（インデックス作成時と読み込み時のアーム構成の一致確認用）"""
+    text = ",".join(f"{float(length):.6f}" for length in link_lengths)
+    return hashlib.sha256(text.encode('utf-8')).digest()[:16]
+
+
+def angles_in_range(angles: Sequence[float]) -> bool:
+    """全関節角度がサーボの範囲内 (0〜180度) か判定"""
+    return all(MIN_ANGLE <= a <= MAX_ANGLE for a in angles)
+
+
+def build_index(link_lengths: Sequence[float] = LINK_LENGTHS,
+                angle_step: float = DEFAULT_ANGLE_STEP,
+                voxel_size: float = DEFAULT_VOXEL_SIZE) -> 'ReachabilityIndex':
+    """関節空間を格子状に走査し、到達可能な手先位置の (x, z) ボクセルグリッドを作成"""
+    num_joints = len(link_lengths)
+    samples = np.deg2rad(np.arange(MIN_ANGLE, MAX_ANGLE + 1e-9, angle_step))
+    grid_shape_joint = (len(samples),) * num_joints
+    total = len(samples) ** num_joints
+
+    # 全リンクを伸ばした長さで作業空間を囲む
+    # 原点がボクセルの中心に来るよう半ボクセルずらす
+    max_reach = float(sum(link_lengths))
+    half_cells = int(np.ceil(max_reach / voxel_size))
+    origin = np.full(2, -(half_cells + 0.5) * voxel_size)
+    shape = (2 * half_cells + 1,) * 2
+    grid = np.zeros(shape, dtype=np.uint8)
+
+    print(f"関節空間を走査中: {len(samples)}^{num_joints} = {total} 姿勢 (ステップ {angle_step}°)")
+    start_time = time.time()
+    for start in range(0, total, SWEEP_CHUNK_SIZE):
+        flat = np.arange(start, min(start + SWEEP_CHUNK_SIZE, total))
+        joint_idx = np.stack(np.unravel_index(flat, grid_shape_joint), axis=1)
+        positions = forward_kinematics_batch(samples[joint_idx], link_lengths)[:, [0, 2]]
+        voxels = np.floor((positions - origin) / voxel_size).astype(np.intp)
+        grid[voxels[:, 0], voxels[:, 1]] = 1
+    elapsed = time.time() - start_time
+    print(f"走査完了: 到達可能ボクセル {int(grid.sum())} / {grid.size} ({elapsed:.1f}秒)")
+
+    return ReachabilityIndex(grid, origin, voxel_size, angle_step, max_reach,
+                             link_lengths_digest(link_lengths))
+
+
+class ReachabilityIndex:
+    """到達可能領域の (x, z) ボクセルインデックス（O(1)で問い合わせ可能）"""
+
+    def __init__(self, grid: np.ndarray, origin: Sequence[float], voxel_size: float,
+                 angle_step: float, max_reach: float, links_digest: bytes):
+        self.grid = grid
+        self.origin = np.asarray(origin, dtype=np.float64)
+        self.voxel_size = voxel_size
+        self.angle_step = angle_step
+        self.max_reach = max_reach
+        self.links_digest = links_digest
+
+    def save(self, path: str):
+        """インデックスをメモリマップ可能なファイルに保存"""
+        header = struct.pack(HEADER_FORMAT, INDEX_MAGIC, self.voxel_size,
+                             *self.origin, *self.grid.shape,
+                             self.angle_step, self.max_reach, self.links_digest)
+        with open(path, 'wb') as f:
+            f.write(header.ljust(HEADER_SIZE, b'\0'))
+            np.ascontiguousarray(self.grid, dtype=np.uint8).tofile(f)
+
+    @classmethod
+    def load(cls, path: str, link_lengths: Sequence[float] = LINK_LENGTHS) -> 'ReachabilityIndex':
+        """
+        インデックスファイルをメモリマップで読み込む（グリッド本体はコピーしない）
+        作成時とリンク長が異なる場合は ValueError（作り直しが必要）
+        """
+        with open(path, 'rb') as f:
+            header = f.read(HEADER_SIZE)
+        if len(header) < HEADER_SIZE:
+            raise ValueError(f"インデックスファイルが不正です: {path}")
+        values = struct.unpack_from(HEADER_FORMAT, header)
+        if values[0] != INDEX_MAGIC:
+            raise ValueError(f"インデックスファイルの形式が不正です: {path}")
+        voxel_size = values[1]
+        origin = values[2:4]
+        shape = tuple(values[4:6])
+        angle_step, max_reach, links_digest = values[6:9]
+        if links_digest != link_lengths_digest(link_lengths):
+            raise ValueError(f"インデックス作成時とリンク長が異なります。再作成してください: {path}")
+        grid = np.memmap(path, dtype=np.uint8, mode='r', offset=HEADER_SIZE, shape=shape)
+        return cls(grid, origin, voxel_size, angle_step, max_reach, links_digest)
+
+    def _voxel_of(self, x: float, z: float) -> Tuple[int, int]:
+        """XZ座標をボクセル番号に変換"""
+        return (int(np.floor((x - self.origin[0]) / self.voxel_size)),
+                int(np.floor((z - self.origin[1]) / self.voxel_size)))
+
+    def is_reachable(self, point: Sequence[float], tolerance: float = 0.0) -> bool:
+        """
+        手先位置 (x, y, z) [mm] が到達可能か判定
+        tolerance [mm] を指定すると周囲のボクセルも探索する（格子走査の隙間対策）
+        """
+        if len(point) != 3:
+            raise ValueError(f"座標は (x, y, z) の3要素で指定してください: {point}")
+        x, y, z = (float(p) for p in point)
+        radius = int(np.ceil(tolerance / self.voxel_size))
+        # 到達可能な点は y=0 のボクセル（|y| <= voxel/2）にしかない
+        if abs(int(np.floor(y / self.voxel_size + 0.5))) > radius:
+            return False
+        center = self._voxel_of(x, z)
+        lo = [max(c - radius, 0) for c in center]
+        hi = [min(c + radius + 1, n) for c, n in zip(center, self.grid.shape)]
+        if any(l >= h for l, h in zip(lo, hi)):
+            return False
+        return bool(self.grid[lo[0]:hi[0], lo[1]:hi[1]].any())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ロボットアーム到達可能領域インデックス作成ツール')
+    parser.add_argument('--output', '-o', default=DEFAULT_INDEX_PATH, help='インデックスファイルのパス')
+    parser.add_argument('--step', type=float, default=DEFAULT_ANGLE_STEP, help='関節角度の走査ステップ（度）')
+    parser.add_argument('--voxel', type=float, default=DEFAULT_VOXEL_SIZE, help='ボクセルサイズ（mm）')
+    parser.add_argument('--query', help='到達判定する座標 x,y,z（mm）。指定時は既存インデックスを読み込む')
+    parser.add_argument('--tolerance', type=float, default=0.0, help='到達判定の許容誤差（mm）')
+
+    args = parser.parse_args()
+
+    if args.query:
+        start_time = time.time()
+        index = ReachabilityIndex.load(args.output)
+        load_ms = (time.time() - start_time) * 1000
+        try:
+            point: List[float] = [float(v) for v in args.query.split(',')]
+            reachable = index.is_reachable(point, tolerance=args.tolerance)
+        except ValueError as e:
+            parser.error(str(e))
+        print(f"インデックス読み込み: {load_ms:.2f}ms (形状 {index.grid.shape}, ボクセル {index.voxel_size}mm)")
+        print(f"座標 {point}: {'到達可能' if reachable else '到達不可'}")
+        return
+
+    index = build_index(LINK_LENGTHS, angle_step=args.step, voxel_size=args.voxel)
+    index.save(args.output)
+    print(f"✓ インデックスを保存しました: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
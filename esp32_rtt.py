@@ -0,0 +1,99 @@
+import socket
+from typing import Dict, Optional
+
+# 再送してよい（何度実行しても結果が変わらない）コマンド
+IDEMPOTENT_COMMANDS = {"GET_JOINT_ANGLES", "GET_SYSTEM_STATUS"}
+
+
+def is_idempotent(command: str) -> bool:
+    """再送可能なコマンドか判定"""
+    return command.strip().split(',')[0] in IDEMPOTENT_COMMANDS
+
+
+def drain_socket(sock: socket.socket):
+    """タイムアウト後に遅れて届いた古い応答を読み捨てる"""
+    timeout = sock.gettimeout()
+    sock.setblocking(False)
+    try:
+        while True:
+            sock.recvfrom(1024)
+    except OSError:
+        pass
+    finally:
+        sock.settimeout(timeout)
+
+
+class RttEstimator:
+    """
+    アームごとのRTT推定器（RFC 6298 の SRTT/RTTVAR 方式）
+    推定したRTTからタイムアウト値(RTO)を決め、タイムアウト時は指数バックオフする
+    """
+
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+    K = 4
+
+    def __init__(self, initial_rto: float = 2.0, min_rto: float = 0.02, max_rto: float = 2.0):
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.rto = min(max(initial_rto, min_rto), max_rto)
+        self.srtt: Optional[float] = None
+        self.rttvar: Optional[float] = None
+
+        # 統計
+        self.requests = 0
+        self.replies = 0
+        self.timeouts = 0
+        self.retries = 0
+        self.last_rtt: Optional[float] = None
+
+    def _clamp(self, value: float) -> float:
+        return min(max(value, self.min_rto), self.max_rto)
+
+    def on_send(self, retry: bool = False):
+        self.requests += 1
+        if retry:
+            self.retries += 1
+
+    def on_reply(self, rtt: Optional[float]):
+        """
+        応答受信時に呼ぶ
+        再送したリクエストの応答はどの送信に対するものか分からないため rtt=None で渡す（Karnのアルゴリズム）
+        """
+        self.replies += 1
+        if rtt is None:
+            return
+        self.last_rtt = rtt
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+        self.rto = self._clamp(self.srtt + self.K * self.rttvar)
+
+    def on_timeout(self, backoff: bool = True):
+        """タイムアウト時に呼ぶ（backoff=True ならRTOを倍にする）"""
+        self.timeouts += 1
+        if backoff:
+            self.rto = self._clamp(self.rto * 2)
+
+    @property
+    def loss_rate(self) -> float:
+        return self.timeouts / self.requests if self.requests else 0.0
+
+    def stats(self) -> Dict:
+        """RTT・損失の統計（時間はミリ秒）"""
+        def ms(value: Optional[float]) -> Optional[float]:
+            return round(value * 1000, 2) if value is not None else None
+        return {
+            "srtt_ms": ms(self.srtt),
+            "rttvar_ms": ms(self.rttvar),
+            "rto_ms": ms(self.rto),
+            "last_rtt_ms": ms(self.last_rtt),
+            "requests": self.requests,
+            "replies": self.replies,
+            "timeouts": self.timeouts,
+            "retries": self.retries,
+            "loss_rate": round(self.loss_rate, 4)
+        }
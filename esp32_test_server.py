@@ -4,14 +4,26 @@ import sys
 import threading
 import time
 import math
+import os
+import heapq
+import ipaddress
+import itertools
+import struct
 from typing import Dict, List, Optional
 
+from esp32_joint_history import DEFAULT_CAPACITY, JointHistory, resolve_time
+from esp32_trace import Tracer, split_trace_tag
+
+HISTORY_IDLE_INTERVAL = 1.0  # 停止中に関節履歴を記録する間隔（秒）
+
 class ESP32RobotMockServer:
     """
     ESP32ロボットアームのモックサーバー（実際のプロトコルに準拠）
     """
     
-    def __init__(self, host: str = '127.0.0.1', port: int = 4210, num_joints: int = 6):
+    def __init__(self, host: str = '127.0.0.1', port: int = 4210, num_joints: int = 6,
+                 trace_path: str = 'esp32_server_trace.json', trace_sample_rate: float = 0.0,
+                 history_size: int = DEFAULT_CAPACITY, history_dir: str = '.'):
         self.host = host
         self.port = port
         self.num_joints = num_joints
@@ -35,6 +47,14 @@ class ESP32RobotMockServer:
         self.movement_threads = {}
         self.movement_stop_flags = {}
         
+        # 関節履歴（動作中は記録スレッドが20Hzで全関節を1行ずつ記録し GET_JOINT_HISTORY で取得）
+        self.history = JointHistory(num_joints, history_size)
+        self.history_dir = history_dir
+        self._record_history()  # 初期姿勢
+        
+        # トレース（SET_TRACE_SAMPLINGで実行中に切り替え可能）
+        self.tracer = Tracer(trace_path, 'ESP32RobotMockServer', trace_sample_rate)
+        
     def _angle_to_pwm(self, angle: float, max_angle: int = 180) -> int:
         """角度をPWM値に変換（ESP32の実装に合わせる）"""
         if angle <= 0:
@@ -64,6 +84,10 @@ class ESP32RobotMockServer:
         self.sock.bind((self.host, self.port))
         self.running = True
         
+        history_thread = threading.Thread(target=self._history_loop)
+        history_thread.daemon = True
+        history_thread.start()
+        
         print(f"ESP32 ロボットアームモックサーバー起動")
         print(f"アドレス: {self.host}:{self.port}")
         print(f"関節数: {self.num_joints}")
@@ -73,14 +97,19 @@ class ESP32RobotMockServer:
             while self.running:
                 # データを受信
                 data, addr = self.sock.recvfrom(1024)
+                received_at = time.time()
                 
                 # 別スレッドで処理
-                thread = threading.Thread(target=self._handle_request, args=(data, addr))
+                thread = threading.Thread(target=self._handle_request, args=(data, addr, received_at))
                 thread.daemon = True
                 thread.start()
                 
         except KeyboardInterrupt:
             print("\n\nサーバーを終了します...")
+        except OSError:
+            # stop() でソケットを閉じた場合は正常終了
+            if self.running:
+                raise
         finally:
             self.stop()
     
@@ -88,28 +117,50 @@ class ESP32RobotMockServer:
         """サーバーを停止"""
         self.running = False
         # すべての動作を停止
-        for flag in self.movement_stop_flags.values():
-            flag.set()
+        self._stop_movements()
         if self.sock:
             self.sock.close()
+        self.tracer.close()
     
-    def _handle_request(self, data: bytes, addr: tuple):
+    def _handle_request(self, data: bytes, addr: tuple, received_at: Optional[float] = None):
         """リクエストを処理"""
+        handler_start = time.time()
         timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
         
         try:
             # データをデコード
+            parse_start = time.time()
             command = data.decode('utf-8').strip()  # 改行コードを削除
+            # クライアントから渡されたトレースIDはサンプリング有効時に常に採用
+            command, client_trace_id = split_trace_tag(command)
+            trace_id = None
+            if client_trace_id is not None and self.tracer.sample_rate > 0:
+                trace_id = client_trace_id
+            elif self.tracer.should_sample():
+                trace_id = self.tracer.new_trace_id()
+            cmd_name = command.split(',')[0]
+            if received_at is not None:
+                self.tracer.complete("server_receive", trace_id, received_at, handler_start, command=cmd_name)
+                if trace_id == client_trace_id:
+                    self.tracer.flow(trace_id, start=False, ts=received_at)
+            self.tracer.complete("parse", trace_id, parse_start, time.time(), command=cmd_name)
             print(f"\n[{timestamp}] 受信 from {addr[0]}:{addr[1]}")
             print(f"コマンド: [{command}]")
             
             # レスポンスを生成
-            response = self._process_command(command, addr)
+            with self.tracer.span("handler", trace_id, command=cmd_name):
+                response = self._process_command(command, addr, trace_id)
             
             # レスポンスを送信（改行コードなし）
             if response:
-                self.sock.sendto(response.encode('utf-8'), addr)
-                print(f"応答: [{response}]")
+                with self.tracer.span("reply_send", trace_id, command=cmd_name):
+                    self.sock.sendto(response.encode('utf-8'), addr)
+                if response.startswith("HISTORY,"):
+                    # 履歴応答は最大60KB程度あるため、base64本体は表示しない
+                    header = response.rsplit(',', 1)[0]
+                    print(f"応答: [{header},...] ({len(response)}バイト)")
+                else:
+                    print(f"応答: [{response}]")
             
             print("-" * 50)
             
@@ -118,8 +169,12 @@ class ESP32RobotMockServer:
             error_response = f"ERROR: {str(e)}"
             self.sock.sendto(error_response.encode('utf-8'), addr)
     
-    def _process_command(self, command: str, addr: tuple) -> str:
-        """コマンドを処理してレスポンスを返す"""
+    def _process_command(self, command: str, addr: tuple, trace_id: Optional[str] = None,
+                         start_time: Optional[float] = None) -> str:
+        """
+        コマンドを処理してレスポンスを返す
+        start_time を指定すると動作をその時刻基準で進める（フリートの同時実行用）
+        """
         parts = command.split(',')
         cmd = parts[0]
         
@@ -155,7 +210,7 @@ class ESP32RobotMockServer:
                     
                     if 0 <= joint_id < self.num_joints:
                         # 動作シミュレーション
-                        self._simulate_joint_movement(joint_id, angle, speed)
+                        self._simulate_joint_movement(joint_id, angle, speed, trace_id, start_time)
                         print(f"✓ 関節{joint_id}を{angle}°に設定 (速度: {speed}°/s)")
                         return "OK"
                     else:
@@ -178,7 +233,7 @@ class ESP32RobotMockServer:
                     
                     # 全関節の動作シミュレーション
                     for i, angle in enumerate(angles):
-                        self._simulate_joint_movement(i, angle, speed)
+                        self._simulate_joint_movement(i, angle, speed, trace_id, start_time)
                     
                     print(f"✓ 全関節角度設定: {angles} (速度: {speed}°/s)")
                     return "OK"
@@ -191,8 +246,7 @@ class ESP32RobotMockServer:
             
         elif cmd == "EMERGENCY_STOP":
             # すべての動作を停止
-            for flag in self.movement_stop_flags.values():
-                flag.set()
+            self._stop_movements()
             print("⚠️ 緊急停止実行")
             return "OK"
             
@@ -206,17 +260,96 @@ class ESP32RobotMockServer:
             }
             return json.dumps(status)
             
+        elif cmd == "GET_JOINT_HISTORY":
+            # GET_JOINT_HISTORY,<t0>,<t1>[,decimate] (0以下の時刻は現在からの相対秒)
+            if len(parts) >= 3:
+                try:
+                    now = time.time()
+                    t0 = resolve_time(float(parts[1]), now)
+                    t1 = resolve_time(float(parts[2]), now)
+                    decimate = int(parts[3]) if len(parts) >= 4 else 1
+                    response = self.history.encode(t0, t1, decimate)
+                    print(f"→ 関節履歴: {response.split(',')[1]}行 (間引き {response.split(',')[2]})")
+                    return response
+                except ValueError as e:
+                    print(f"✗ パラメータエラー: {e}")
+                    return "NG"
+            print("✗ パラメータ不足")
+            return "NG"
+            
+        elif cmd == "DUMP_JOINT_HISTORY":
+            # DUMP_JOINT_HISTORY[,<t0>,<t1>] 履歴をサーバー側の .npy ファイルに保存
+            try:
+                now = time.time()
+                t0 = resolve_time(float(parts[1]), now) if len(parts) >= 3 else -math.inf
+                t1 = resolve_time(float(parts[2]), now) if len(parts) >= 3 else math.inf
+                filename = datetime.datetime.now().strftime("joint_history_%Y%m%d_%H%M%S_%f.npy")
+                path = os.path.join(self.history_dir, filename)
+                rows = self.history.dump(path, t0, t1)
+                print(f"✓ 関節履歴を保存: {path} ({rows}行)")
+                return f"OK,{path}"
+            except (ValueError, OSError) as e:
+                print(f"✗ 履歴保存エラー: {e}")
+                return "NG"
+            
+        elif cmd == "SET_TRACE_SAMPLING":
+            # トレースのサンプリング率を実行中に変更 (0.0で無効, 1.0で全コマンド)
+            if len(parts) >= 2:
+                try:
+                    self.tracer.sample_rate = float(parts[1])
+                    print(f"✓ トレースサンプリング率: {self.tracer.sample_rate} ({self.tracer.path})")
+                    return "OK"
+                except ValueError as e:
+                    print(f"✗ パラメータエラー: {e}")
+                    return "NG"
+            print("✗ パラメータ不足")
+            return "NG"
+            
         else:
             print(f"✗ 不明なコマンド: [{cmd}]")
             return f"ERROR: Unknown command: {cmd}"
     
-    def _simulate_joint_movement(self, joint_id: int, target_angle: float, speed: float):
-        """関節の動作をシミュレート"""
+    def _record_history(self):
+        """現在の全関節の角度とPWMを履歴に追加"""
+        self.history.record(self.joint_angles, [pwm['off_time'] for pwm in self.servo_pwm])
+    
+    def _history_loop(self):
+        """
+        動作中の関節があれば20Hzで全関節の状態を1行記録する
+        関節ごとのスレッドからは記録しないため、1周期に1行・等間隔になる
+        停止中も HISTORY_IDLE_INTERVAL 秒ごとに1行記録し、どの時間範囲を問い合わせても姿勢が分かるようにする
+        """
+        was_moving = False
+        last_recorded = time.time()
+        while self.running:
+            moving = any(thread.is_alive() for thread in list(self.movement_threads.values()))
+            # 動作終了直後も1行記録して最終位置を残す
+            if moving or was_moving or time.time() - last_recorded >= HISTORY_IDLE_INTERVAL:
+                self._record_history()
+                last_recorded = time.time()
+            was_moving = moving
+            time.sleep(0.05)  # 50ms = 20Hz
+    
+    def _stop_movements(self, joint_ids: Optional[List[int]] = None) -> List[threading.Thread]:
+        """指定関節（省略時は全関節）の動作に停止を指示し、まだ動いているスレッドを返す（待たない）"""
+        threads = []
+        for joint_id, flag in list(self.movement_stop_flags.items()):
+            if joint_ids is not None and joint_id not in joint_ids:
+                continue
+            flag.set()
+            thread = self.movement_threads.get(joint_id)
+            if thread is not None and thread.is_alive():
+                threads.append(thread)
+        return threads
+    
+    def _simulate_joint_movement(self, joint_id: int, target_angle: float, speed: float,
+                                 trace_id: Optional[str] = None, start_time: Optional[float] = None):
+        """関節の動作をシミュレート（start_time 省略時は既存の動作を止めた時刻から開始）"""
         # 既存の動作を停止
-        if joint_id in self.movement_stop_flags:
-            self.movement_stop_flags[joint_id].set()
-            if joint_id in self.movement_threads:
-                self.movement_threads[joint_id].join(timeout=0.1)
+        for thread in self._stop_movements([joint_id]):
+            thread.join(timeout=0.1)
+        if start_time is None:
+            start_time = time.time()
         
         # 停止フラグを作成
         stop_flag = threading.Event()
@@ -238,10 +371,11 @@ class ESP32RobotMockServer:
             
             print(f"  → 関節{joint_id}動作開始: {start_angle:.1f}° → {target_angle:.1f}° ({duration:.1f}秒)")
             
-            start_time = time.time()
+            interrupted = False
             for i in range(steps + 1):
                 if stop_flag.is_set():
                     print(f"  → 関節{joint_id}動作中断")
+                    interrupted = True
                     break
                     
                 progress = i / steps if steps > 0 else 1
@@ -255,13 +389,18 @@ class ESP32RobotMockServer:
                     elapsed = time.time() - start_time
                     print(f"  → 関節{joint_id}: {current_angle:.1f}° ({progress*100:.0f}%) [{elapsed:.1f}秒]")
                     
-                time.sleep(0.05)  # 50ms = 20Hz
+                # 50ms = 20Hz（開始時刻基準で刻むため、同時に開始した関節・アームは同じ周期で動く）
+                # 停止指示があればすぐに抜ける
+                stop_flag.wait(max(start_time + (i + 1) * 0.05 - time.time(), 0))
             
             if not stop_flag.is_set():
                 # 最終位置を確実にセット
                 self.servo_pwm[joint_id]['off_time'] = target_pwm
                 self.joint_angles[joint_id] = target_angle
                 print(f"  → 関節{joint_id}動作完了: {target_angle:.1f}°")
+            
+            self.tracer.complete("motion", trace_id, start_time, time.time(),
+                                 joint=joint_id, target=target_angle, interrupted=interrupted)
         
         # 新しい動作スレッドを開始
         thread = threading.Thread(target=move)
@@ -270,6 +409,179 @@ class ESP32RobotMockServer:
         self.movement_threads[joint_id] = thread
 
 
+class ESP32FleetMockServer:
+    """
+    複数アームのモックサーバー群
+    各アームは個別のUDPポートでユニキャストコマンドを受け付け、
+    グループ宛て（マルチキャスト/ブロードキャスト）コマンドは全アームが同じ時刻に実行して1つのACKで応答する
+    予約されたグループコマンドは1本のスケジューラスレッドが時刻順に1つずつ実行し、
+    緊急停止は未実行の予約をすべて取り消してから即時実行する
+    """
+    
+    def __init__(self, host: str = '127.0.0.1', base_port: int = 4210, num_arms: int = 2,
+                 num_joints: int = 6, group_id: int = 1, group_address: str = '239.255.42.10',
+                 group_port: int = 4200, trace_path: str = 'esp32_server_trace.json', **arm_kwargs):
+        # グループ受信ポートがアームのポートと重なると bind に失敗するため先に検出する
+        if base_port <= group_port < base_port + num_arms:
+            raise ValueError(f"グループポート {group_port} がアームのポート範囲 "
+                             f"{base_port}〜{base_port + num_arms - 1} と重なっています")
+        self.group_id = group_id
+        self.group_address = group_address
+        self.group_port = group_port
+        self.sock = None
+        self.running = False
+        
+        # グループコマンドの予約キュー（実行時刻順のヒープ）
+        self._schedule: List[tuple] = []
+        self._schedule_cond = threading.Condition()
+        self._schedule_seq = itertools.count()
+        self._epoch = 0                       # 緊急停止のたびに進め、それ以前の予約を無効にする
+        self._execute_lock = threading.Lock()  # グループコマンドは1つずつ実行する
+        
+        # トレースファイルはアームごとに分ける
+        root, ext = os.path.splitext(trace_path)
+        self.arms = [
+            ESP32RobotMockServer(host=host, port=base_port + i, num_joints=num_joints,
+                                 trace_path=f"{root}_{base_port + i}{ext}", **arm_kwargs)
+            for i in range(num_arms)
+        ]
+    
+    def start(self):
+        """全アームとグループ受信を起動"""
+        for arm in self.arms:
+            thread = threading.Thread(target=arm.start)
+            thread.daemon = True
+            thread.start()
+        
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('', self.group_port))
+        if ipaddress.ip_address(self.group_address).is_multicast:
+            mreq = struct.pack('4s4s', socket.inet_aton(self.group_address), socket.inet_aton('0.0.0.0'))
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+        self.running = True
+        
+        scheduler = threading.Thread(target=self._scheduler_loop)
+        scheduler.daemon = True
+        scheduler.start()
+        
+        print(f"ESP32 フリートモックサーバー起動")
+        print(f"アーム数: {len(self.arms)} (ポート {self.arms[0].port}〜{self.arms[-1].port})")
+        print(f"グループ: {self.group_id} ({self.group_address}:{self.group_port})")
+        print("-" * 50)
+        
+        try:
+            while self.running:
+                data, addr = self.sock.recvfrom(1024)
+                self._handle_group_request(data, addr)
+        except KeyboardInterrupt:
+            print("\n\nサーバーを終了します...")
+        finally:
+            self.stop()
+    
+    def stop(self):
+        """全アームを停止"""
+        with self._schedule_cond:
+            self.running = False
+            self._schedule.clear()
+            self._schedule_cond.notify_all()
+        for arm in self.arms:
+            arm.stop()
+        if self.sock:
+            self.sock.close()
+    
+    def _handle_group_request(self, data: bytes, addr: tuple):
+        """GROUP,<group_id>,<execute_at>,<command...> を受信して実行を予約"""
+        try:
+            parts = data.decode('utf-8').strip().split(',', 3)
+            if len(parts) < 4 or parts[0] != "GROUP":
+                print(f"✗ 不正なグループコマンド: {data!r}")
+                return
+            group_id = int(parts[1])
+            execute_at = float(parts[2])
+            command = parts[3]
+        except ValueError as e:
+            print(f"✗ グループコマンドのパラメータエラー: {e}")
+            return
+        
+        # 0 は全グループ宛て、それ以外で自グループでなければ無視（応答もしない）
+        if group_id not in (0, self.group_id):
+            return
+        
+        # 緊急停止は予約時刻を無視し、未実行の予約を取り消して即実行
+        if command.split(',')[0] == "EMERGENCY_STOP":
+            with self._schedule_cond:
+                cancelled = len(self._schedule)
+                self._schedule.clear()
+                self._epoch += 1
+                epoch = self._epoch
+            print(f"\n[グループ{group_id}] 緊急停止 from {addr[0]}:{addr[1]} (予約{cancelled}件を取り消し)")
+            self._execute_group_command(group_id, command, 0.0, addr, epoch)
+            return
+        
+        now = time.time()
+        run_at = execute_at if execute_at > 0 else now
+        print(f"\n[グループ{group_id}] 受信 from {addr[0]}:{addr[1]}: [{command}] "
+              f"({max(run_at - now, 0.0) * 1000:.0f}ms後に実行)")
+        with self._schedule_cond:
+            heapq.heappush(self._schedule, (run_at, next(self._schedule_seq), self._epoch,
+                                            group_id, command, execute_at, addr))
+            self._schedule_cond.notify()
+    
+    def _scheduler_loop(self):
+        """予約時刻になったグループコマンドを順番に実行"""
+        while True:
+            with self._schedule_cond:
+                while self.running and (not self._schedule or self._schedule[0][0] > time.time()):
+                    timeout = self._schedule[0][0] - time.time() if self._schedule else None
+                    self._schedule_cond.wait(timeout)
+                if not self.running:
+                    return
+                _, _, epoch, group_id, command, execute_at, addr = heapq.heappop(self._schedule)
+            self._execute_group_command(group_id, command, execute_at, addr, epoch)
+    
+    def _motion_joints(self, command: str) -> List[int]:
+        """コマンドで動かす関節（動作コマンド以外は空リスト）"""
+        parts = command.split(',')
+        if parts[0] == "SET_ALL_JOINT_ANGLES":
+            return list(range(self.arms[0].num_joints))
+        if parts[0] == "SET_JOINT_ANGLE" and len(parts) >= 2:
+            try:
+                return [int(parts[1])]
+            except ValueError:
+                pass
+        return []
+    
+    def _execute_group_command(self, group_id: int, command: str, execute_at: float, addr: tuple, epoch: int):
+        """全アームで同時にコマンドを実行し、集約ACKを返す"""
+        with self._execute_lock:
+            # 予約後に緊急停止があれば実行しない
+            if epoch != self._epoch:
+                print(f"✗ グループ{group_id}: 緊急停止により取り消し [{command}]")
+                return
+            
+            # 前の動作は全アームにまとめて停止を指示してから待つ（アームごとに待つと開始がずれる）
+            joints = self._motion_joints(command)
+            if joints:
+                threads = [thread for arm in self.arms for thread in arm._stop_movements(joints)]
+                for thread in threads:
+                    thread.join(timeout=0.1)
+            
+            # 全アームの動作を同じ開始時刻から進める
+            executed_at = time.time()
+            results = [arm._process_command(command, addr, start_time=executed_at) for arm in self.arms]
+        ok = sum(1 for r in results if r and r != "NG" and not r.startswith("ERROR"))
+        lateness_ms = (executed_at - execute_at) * 1000 if execute_at > 0 else 0.0
+        print(f"✓ グループ{group_id}実行: {ok}/{len(self.arms)} OK (予定時刻との差 {lateness_ms:.1f}ms)")
+        
+        # GROUP_ACK,<group_id>,<成功数>/<アーム数>,<実行時刻>,<アーム0の応答>|<アーム1の応答>|...
+        response = f"GROUP_ACK,{group_id},{ok}/{len(self.arms)},{executed_at:.6f}," + "|".join(results)
+        try:
+            self.sock.sendto(response.encode('utf-8'), addr)
+        except OSError as e:
+            print(f"エラー: {e}")
+
+
 def main():
     """メイン関数"""
     import argparse
@@ -278,6 +590,14 @@ def main():
     parser.add_argument('--host', default='127.0.0.1', help='ホストアドレス')
     parser.add_argument('--port', type=int, default=4210, help='ポート番号')
     parser.add_argument('--joints', type=int, default=6, help='関節数')
+    parser.add_argument('--trace', default='esp32_server_trace.json', help='トレース出力ファイル（Chrome trace形式）')
+    parser.add_argument('--trace-sample', type=float, default=0.0, help='トレースのサンプリング率 (0.0〜1.0)')
+    parser.add_argument('--history-size', type=int, default=DEFAULT_CAPACITY, help='関節履歴の最大行数')
+    parser.add_argument('--history-dir', default='.', help='DUMP_JOINT_HISTORY の保存先ディレクトリ')
+    parser.add_argument('--fleet', type=int, default=0, help='フリートモードのアーム数（ポートは --port から連番）')
+    parser.add_argument('--group-id', type=int, default=1, help='フリートのグループID')
+    parser.add_argument('--group-addr', default='239.255.42.10', help='グループ宛てコマンドのマルチキャスト/ブロードキャストアドレス')
+    parser.add_argument('--group-port', type=int, default=4200, help='グループ宛てコマンドのポート')
     
     args = parser.parse_args()
     
@@ -291,7 +611,21 @@ def main():
         print(f"echo -n 'SET_ALL_JOINT_ANGLES,10,-10,20,-20,30,-30,40.0' | nc -u {args.host} {args.port}")
         print()
     
-    server = ESP32RobotMockServer(host=args.host, port=args.port, num_joints=args.joints)
+    if args.fleet > 0:
+        try:
+            fleet = ESP32FleetMockServer(host=args.host, base_port=args.port, num_arms=args.fleet,
+                                         num_joints=args.joints, group_id=args.group_id,
+                                         group_address=args.group_addr, group_port=args.group_port,
+                                         trace_path=args.trace, trace_sample_rate=args.trace_sample,
+                                         history_size=args.history_size, history_dir=args.history_dir)
+        except ValueError as e:
+            parser.error(str(e))
+        fleet.start()
+        return
+    
+    server = ESP32RobotMockServer(host=args.host, port=args.port, num_joints=args.joints,
+                                  trace_path=args.trace, trace_sample_rate=args.trace_sample,
+                                  history_size=args.history_size, history_dir=args.history_dir)
     server.start()
 
 
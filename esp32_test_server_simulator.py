@@ -5,10 +5,14 @@ import matplotlib.animation as animation
 import socket
 import time
 
+from esp32_rtt import RttEstimator, drain_socket
+
 # --- サーバー設定 ---
 SERVER_HOST = '127.0.0.1'  # モックサーバーのホスト
 SERVER_PORT = 4210         # モックサーバーのポート
-UDP_TIMEOUT = 0.5          # UDP受信のタイムアウト (秒)
+UDP_TIMEOUT = 0.5          # UDP受信のタイムアウト上限 (秒)
+UDP_MIN_TIMEOUT = 0.01     # UDP受信のタイムアウト下限 (秒)
+UDP_MAX_RETRIES = 1        # GET_JOINT_ANGLES の再送回数
 
 # --- ロボットアーム設定 ---
 # モックサーバーのデフォルト関節数は6
@@ -23,6 +27,8 @@ ANIMATION_INTERVAL = 50 # アニメーションのフレーム間隔 (ミリ秒)
 # --- UDPソケットの準備 ---
 udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 udp_socket.settimeout(UDP_TIMEOUT)
+# RTTからタイムアウト値を適応的に決める
+rtt_estimator = RttEstimator(initial_rto=UDP_TIMEOUT, min_rto=UDP_MIN_TIMEOUT, max_rto=UDP_TIMEOUT)
 
 # サーバーに接続メッセージを送信 (オプション)
 try:
@@ -43,10 +49,26 @@ except Exception as e:
 
 
 def get_angles_from_server():
-    """モックサーバーから現在の関節角度を取得する"""
+    """モックサーバーから現在の関節角度を取得する（タイムアウト時は再送）"""
+    data = b''
     try:
-        udp_socket.sendto("GET_JOINT_ANGLES".encode('utf-8'), (SERVER_HOST, SERVER_PORT))
-        data, _ = udp_socket.recvfrom(1024) # buffer size 1024
+        drain_socket(udp_socket)  # 前回タイムアウトした要求への遅延応答を読み捨てる
+        for attempt in range(1 + UDP_MAX_RETRIES):
+            udp_socket.settimeout(rtt_estimator.rto)
+            sent_at = time.perf_counter()
+            udp_socket.sendto("GET_JOINT_ANGLES".encode('utf-8'), (SERVER_HOST, SERVER_PORT))
+            rtt_estimator.on_send(retry=attempt > 0)
+            try:
+                data, _ = udp_socket.recvfrom(1024) # buffer size 1024
+            except socket.timeout:
+                rtt_estimator.on_timeout()
+                continue
+            # 再送後の応答はRTTの計測に使わない（Karnのアルゴリズム）
+            rtt_estimator.on_reply(time.perf_counter() - sent_at if attempt == 0 else None)
+            break
+        else:
+            # print("警告: GET_JOINT_ANGLES サーバーからの応答がタイムアウトしました。") # 頻繁に出る場合はコメントアウト
+            return None
         angles_deg_str = data.decode('utf-8').split(',')
         
         if len(angles_deg_str) == NUM_JOINTS:
@@ -56,9 +78,6 @@ def get_angles_from_server():
         else:
             print(f"エラー: サーバーから予期しない数の関節角度が返されました。受信: {len(angles_deg_str)}, 期待: {NUM_JOINTS}")
             return None
-    except socket.timeout:
-        # print("警告: GET_JOINT_ANGLES サーバーからの応答がタイムアウトしました。") # 頻繁に出る場合はコメントアウト
-        return None
     except ValueError as e:
         print(f"エラー: サーバーからの角度データの変換に失敗: {e}. データ: '{data.decode('utf-8')}'")
         return None
@@ -167,6 +186,7 @@ ani = animation.FuncAnimation(fig, update_animation, frames=None, # リアルタ
 # ウィンドウクローズ時の処理
 def on_close(event):
     print("ウィンドウが閉じられました。サーバーから切断します...")
+    print(f"RTT統計: {rtt_estimator.stats()}")
     try:
         udp_socket.sendto("DISCONNECT".encode('utf-8'), (SERVER_HOST, SERVER_PORT))
         # 応答は待たなくても良い場合もある
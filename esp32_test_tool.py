@@ -5,11 +5,18 @@ import json
 import argparse
 from typing import List, Dict, Optional, Union
 
+from esp32_rtt import RttEstimator, drain_socket, is_idempotent
+from esp32_trace import Tracer, add_trace_tag
+
+UDP_TIMEOUT = 2.0  # 再送しないコマンドの固定タイムアウト（秒）
+
 class ESP32RobotTester:
     """ESP32ロボットアームのテストツール（UDP/HTTP両対応・複数IP対応）"""
 
     def __init__(self, ip_addresses: Union[str, List[str]] = "127.0.0.1", udp_port: int = 4210,
-                 http_port: int = 80, use_mock: bool = True):
+                 http_port: int = 80, use_mock: bool = True, trace_path: Optional[str] = None,
+                 max_retries: int = 2, group_address: str = '239.255.42.10', group_port: int = 4200,
+                 group_delay: float = 0.1):
         # 複数IP対応
         if isinstance(ip_addresses, str):
             self.ip_addresses = [ip.strip() for ip in ip_addresses.split(",")]
@@ -22,29 +29,143 @@ class ESP32RobotTester:
 
         # UDP用ソケット
         self.udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.udp_sock.settimeout(2.0)
+        self.udp_sock.settimeout(UDP_TIMEOUT)
+
+        # アームごとのRTT推定（読み取り系コマンドのタイムアウト値を適応的に決める）
+        # 読み取り系コマンドはタイムアウト時に max_retries 回まで再送する
+        # 制御コマンドは再送しないため、固定タイムアウト UDP_TIMEOUT で待つ
+        self.max_retries = max_retries
+        self.rtt = {ip: RttEstimator(initial_rto=UDP_TIMEOUT, max_rto=UDP_TIMEOUT) for ip in self.ip_addresses}
+
+        # グループ宛て（マルチキャスト/ブロードキャスト）コマンドの送信先
+        self.group_address = group_address
+        self.group_port = group_port
+        self.group_delay = group_delay  # 対話モードでの実行予約までの時間（秒）
+        self.udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self.udp_sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+
+        # トレース（trace_path指定時のみ有効）
+        self.tracer = Tracer(trace_path, 'ESP32RobotTester')
         
+    def _receive_from(self, ip: str, timeout: float) -> bytes:
+        """
+        ip のアームからの応答を timeout 秒まで待つ
+        ソケットは全アームで共有しているため、他のアームからの遅延応答は読み捨てる
+        """
+        deadline = time.perf_counter() + timeout
+        while True:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                raise socket.timeout("timed out")
+            self.udp_sock.settimeout(remaining)
+            data, addr = self.udp_sock.recvfrom(65535)  # GET_JOINT_HISTORY の応答は大きい
+            if addr[0] == ip and addr[1] == self.udp_port:
+                return data
+            print(f"[UDP] 他の送信元からの応答を破棄({addr[0]}:{addr[1]})")
+    
     def send_udp_command(self, command: str) -> Optional[List[str]]:
         """UDPコマンドを全IPに送信して応答を取得"""
         responses = []
         for ip in self.ip_addresses:
+            trace_id = self.tracer.new_trace_id() if self.tracer.should_sample() else None
+            cmd_name = command.strip().split(',')[0]
+            estimator = self.rtt[ip]
+            idempotent = is_idempotent(command)
+            attempts = 1 + (self.max_retries if idempotent else 0)
+            # コマンドに改行を追加（ESP32の実装に合わせる）
+            cmd = command.strip()
+            # トレースIDはモックサーバーのみ解釈できるため実機には付けない
+            if trace_id is not None and self.use_mock:
+                cmd = add_trace_tag(cmd, trace_id)
+            cmd = cmd + '\n'
+            response = None
+            for attempt in range(attempts):
+                try:
+                    # 前回タイムアウトしたリクエストの遅延応答を読み捨てる
+                    # （再送時は同じコマンドへの応答なので読み捨てない）
+                    if attempt == 0:
+                        drain_socket(self.udp_sock)
+                    timeout = estimator.rto if idempotent else UDP_TIMEOUT
+                    if attempt == 0:
+                        print(f"[UDP] 送信({ip}): {command.strip()}")
+                    else:
+                        print(f"[UDP] 再送({ip}) {attempt}/{self.max_retries}: {command.strip()}")
+                    with self.tracer.span("client_send", trace_id, command=cmd_name, ip=ip, attempt=attempt):
+                        self.tracer.flow(trace_id, start=True)
+                        sent_at = time.perf_counter()
+                        self.udp_sock.sendto(cmd.encode('utf-8'), (ip, self.udp_port))
+                    estimator.on_send(retry=attempt > 0)
+                    # 応答を待機
+                    with self.tracer.span("client_wait_reply", trace_id, command=cmd_name, ip=ip, attempt=attempt):
+                        data = self._receive_from(ip, timeout)
+                    # RTTは読み取り系コマンドの初回送信からのみ計測する
+                    # （再送後の応答はどの送信への応答か分からない: Karnのアルゴリズム）
+                    sample = time.perf_counter() - sent_at if idempotent and attempt == 0 else None
+                    estimator.on_reply(sample)
+                    response = data.decode('utf-8').strip()
+                    print(f"[UDP] 受信({ip}): {response}")
+                    break
+                except socket.timeout:
+                    estimator.on_timeout(backoff=idempotent)
+                    if idempotent:
+                        print(f"[UDP] タイムアウト({ip}) 次回タイムアウト: {estimator.rto * 1000:.0f}ms")
+                    else:
+                        print(f"[UDP] タイムアウト({ip})")
+                except Exception as e:
+                    print(f"[UDP] エラー({ip}): {e}")
+                    break
+            responses.append(response)
+        return responses if responses else None
+    
+    def send_group_command(self, command: str, group_id: int = 1, delay: Optional[float] = None,
+                           execute_at: Optional[float] = None, wait: float = 0.5) -> List[str]:
+        """
+        グループ宛てに1パケットでコマンドを送信し、フリートからの集約ACKを受信
+        delay（秒）または execute_at（Unix時刻）を指定すると全アームがその時刻に実行する
+        """
+        if command.strip().split(',')[0] == "EMERGENCY_STOP":
+            # 緊急停止は予約せず即時実行（サーバー側も予約時刻を無視する）
+            execute_at = None
+        elif execute_at is None and delay is not None:
+            execute_at = time.time() + delay
+        message = f"GROUP,{group_id},{execute_at or 0:.6f},{command.strip()}\n"
+        print(f"[GROUP] 送信({self.group_address}:{self.group_port}, グループ{group_id}): {command.strip()}")
+        drain_socket(self.udp_sock)
+        self.udp_sock.sendto(message.encode('utf-8'), (self.group_address, self.group_port))
+        
+        # 実行予定時刻 + wait 秒の間、複数フリートからのACKを集める
+        acks = []
+        deadline = max(execute_at or 0, time.time()) + wait
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            self.udp_sock.settimeout(remaining)
             try:
-                # コマンドに改行を追加（ESP32の実装に合わせる）
-                cmd = command if command.endswith('\n') else command + '\n'
-                print(f"[UDP] 送信({ip}): {cmd.strip()}")
-                self.udp_sock.sendto(cmd.encode('utf-8'), (ip, self.udp_port))
-                # 応答を待機
-                data, addr = self.udp_sock.recvfrom(1024)
-                response = data.decode('utf-8').strip()
-                print(f"[UDP] 受信({ip}): {response}")
-                responses.append(response)
+                data, addr = self.udp_sock.recvfrom(65535)
             except socket.timeout:
-                print(f"[UDP] タイムアウト({ip})")
-                responses.append(None)
-            except Exception as e:
-                print(f"[UDP] エラー({ip}): {e}")
-                responses.append(None)
-        return responses if responses else None
+                break
+            response = data.decode('utf-8').strip()
+            if response.startswith("GROUP_ACK"):
+                print(f"[GROUP] 受信({addr[0]}:{addr[1]}): {response}")
+                acks.append(response)
+        if not acks:
+            print("[GROUP] ACKなし")
+        return acks
+    
+    def get_rtt_stats(self) -> Dict[str, Dict]:
+        """アームごとのRTT・損失統計を取得"""
+        return {ip: estimator.stats() for ip, estimator in self.rtt.items()}
+    
+    def print_rtt_stats(self):
+        """アームごとのRTT・損失統計を表示"""
+        print("\n=== RTT統計 ===")
+        for ip, stats in self.get_rtt_stats().items():
+            srtt = f"{stats['srtt_ms']}ms" if stats['srtt_ms'] is not None else "-"
+            rttvar = f"{stats['rttvar_ms']}ms" if stats['rttvar_ms'] is not None else "-"
+            print(f"  {ip}: SRTT={srtt} RTTVAR={rttvar} "
+                  f"RTO={stats['rto_ms']}ms 損失率={stats['loss_rate'] * 100:.1f}% "
+                  f"(送信 {stats['requests']}, 受信 {stats['replies']}, 再送 {stats['retries']})")
     
     def get_http_servos(self) -> Optional[List[Dict]]:
         """HTTPで全IPのサーボ状態を取得"""
@@ -124,14 +245,21 @@ class ESP32RobotTester:
     def test_udp_connection(self):
         """UDP接続テスト"""
         print("\n=== UDP接続テスト ===")
-        response = self.send_udp_command("CONNECT")
-        if response == "OK":
+        responses = self.send_udp_command("CONNECT")
+        if responses and all(response == "OK" for response in responses):
             print("✓ 接続成功")
             return True
         else:
             print("✗ 接続失敗")
             return False
     
+    def _print_joint_angles(self):
+        """全IPの現在角度を取得して表示"""
+        responses = self.send_udp_command("GET_JOINT_ANGLES") or []
+        for ip, response in zip(self.ip_addresses, responses):
+            if response:
+                print(f"   現在角度({ip}): {response.split(',')}")
+    
     def test_udp_joint_control(self):
         """UDP関節制御テスト"""
         print("\n=== UDP関節制御テスト ===")
@@ -143,10 +271,7 @@ class ESP32RobotTester:
         time.sleep(2)
         
         # 角度取得
-        response = self.send_udp_command("GET_JOINT_ANGLES")
-        if response:
-            angles = response.split(',')
-            print(f"   現在角度: {angles}")
+        self._print_joint_angles()
         
         # 全関節
         print("\n2. 全関節制御")
@@ -155,10 +280,7 @@ class ESP32RobotTester:
         time.sleep(2)
         
         # 角度取得
-        response = self.send_udp_command("GET_JOINT_ANGLES")
-        if response:
-            angles = response.split(',')
-            print(f"   現在角度: {angles}")
+        self._print_joint_angles()
         
         # ホームポジション
         print("\n3. ホームポジション復帰")
@@ -234,11 +356,11 @@ class ESP32RobotTester:
         
         # UDPで確認
         print("\n4. UDPで状態確認")
-        response = self.send_udp_command("GET_JOINT_ANGLES")
-        if response:
-            angles = response.split(',')
-            for i, angle in enumerate(angles[:6]):
-                print(f"   関節{i}: {float(angle):.1f}°")
+        responses = self.send_udp_command("GET_JOINT_ANGLES") or []
+        for ip, response in zip(self.ip_addresses, responses):
+            if response:
+                for i, angle in enumerate(response.split(',')[:6]):
+                    print(f"   {ip} 関節{i}: {float(angle):.1f}°")
     
     def interactive_mode(self):
         """対話モード"""
@@ -249,6 +371,8 @@ class ESP32RobotTester:
         print("  SET_JOINT_ANGLE,0,45.0,30.0")
         print("  SET_ALL_JOINT_ANGLES,10,-10,20,-20,30,-30,40.0")
         print("  DISCONNECT")
+        print("  group SET_ALL_JOINT_ANGLES,0,0,0,0,0,0,50.0 - グループ宛てに送信")
+        print("  stats - RTT統計を表示")
         print("  quit - 終了")
         print("")
         
@@ -257,6 +381,12 @@ class ESP32RobotTester:
                 command = input("コマンド> ").strip()
                 if command.lower() == 'quit':
                     break
+                if command.lower() == 'stats':
+                    self.print_rtt_stats()
+                    continue
+                if command.lower().startswith('group '):
+                    self.send_group_command(command[len('group '):], delay=self.group_delay)
+                    continue
                     
                 if command:
                     self.send_udp_command(command)
@@ -268,7 +398,7 @@ class ESP32RobotTester:
     def run_all_tests(self):
         """全テストを実行"""
         print("ESP32ロボットアーム統合テスト開始")
-        print(f"対象: {self.ip_address}")
+        print(f"対象: {', '.join(self.ip_addresses)}")
         print(f"UDP: {self.udp_port}, HTTP: {self.http_port}")
         print("="*50)
         
@@ -287,6 +417,7 @@ class ESP32RobotTester:
         # 切断
         print("\n=== 切断 ===")
         self.send_udp_command("DISCONNECT")
+        self.print_rtt_stats()
         print("✓ テスト完了")
 
 
@@ -297,6 +428,11 @@ def main():
     parser.add_argument('--http-port', type=int, default=80, help='HTTPポート')
     parser.add_argument('--mock', action='store_true', help='モックサーバーを使用')
     parser.add_argument('--interactive', '-i', action='store_true', help='対話モード')
+    parser.add_argument('--trace', help='トレース出力ファイル（Chrome trace形式）')
+    parser.add_argument('--retries', type=int, default=2, help='読み取りコマンドの最大再送回数')
+    parser.add_argument('--group-addr', default='239.255.42.10', help='グループ宛てコマンドのマルチキャスト/ブロードキャストアドレス')
+    parser.add_argument('--group-port', type=int, default=4200, help='グループ宛てコマンドのポート')
+    parser.add_argument('--group-delay', type=float, default=0.1, help='グループ宛てコマンドの実行予約までの時間（秒）')
     
     args = parser.parse_args()
     
@@ -311,13 +447,21 @@ def main():
         ip_addresses=ip_list,
         udp_port=args.udp_port,
         http_port=args.http_port,
-        use_mock=args.mock
+        use_mock=args.mock,
+        trace_path=args.trace,
+        max_retries=args.retries,
+        group_address=args.group_addr,
+        group_port=args.group_port,
+        group_delay=args.group_delay
     )
     
-    if args.interactive:
-        tester.interactive_mode()
-    else:
-        tester.run_all_tests()
+    try:
+        if args.interactive:
+            tester.interactive_mode()
+        else:
+            tester.run_all_tests()
+    finally:
+        tester.tracer.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,147 @@
+import argparse
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# コマンド末尾に付けるトレースID（モックサーバーのみ対応、実機には付けない）
+TRACE_TAG = ';trace='
+
+
+def add_trace_tag(command: str, trace_id: str) -> str:
+    """コマンドにトレースIDを付加"""
+    return f"{command}{TRACE_TAG}{trace_id}"
+
+
+def split_trace_tag(command: str) -> Tuple[str, Optional[str]]:
+    """コマンドからトレースIDを分離（付いていなければNone）"""
+    if TRACE_TAG in command:
+        command, _, trace_id = command.partition(TRACE_TAG)
+        return command, trace_id.strip() or None
+    return command, None
+
+
+class Tracer:
+    """
+    Chrome trace / Perfetto 形式（JSON配列形式）でスパンを書き出すトレーサー
+    イベントは1行ずつ追記するため、途中で終了してもそこまでのトレースは読み込める
+    """
+
+    def __init__(self, path: Optional[str], process_name: str, sample_rate: float = 1.0):
+        self.path = path
+        self.process_name = process_name
+        self.sample_rate = sample_rate if path else 0.0
+        self.pid = os.getpid()
+        self._file = None
+        self._lock = threading.Lock()
+
+    @property
+    def sample_rate(self) -> float:
+        return self._sample_rate
+
+    @sample_rate.setter
+    def sample_rate(self, rate: float):
+        self._sample_rate = min(max(rate, 0.0), 1.0)
+
+    def should_sample(self) -> bool:
+        """サンプリング率に従ってトレース対象か判定"""
+        return self.path is not None and random.random() < self._sample_rate
+
+    def new_trace_id(self) -> str:
+        return f"{random.getrandbits(64):016x}"
+
+    def _write(self, event: Dict):
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, 'w', encoding='utf-8')
+                self._file.write("[\n")
+                self._file.write(json.dumps({
+                    "name": "process_name", "ph": "M", "pid": self.pid,
+                    "args": {"name": self.process_name}
+                }) + ",\n")
+            self._file.write(json.dumps(event, ensure_ascii=False) + ",\n")
+            self._file.flush()
+
+    def complete(self, name: str, trace_id: Optional[str], start: float, end: float, **args):
+        """開始・終了時刻 (time.time() の秒) からスパンを記録（trace_idがNoneなら何もしない）"""
+        if trace_id is None or self.path is None:
+            return
+        args['trace_id'] = trace_id
+        self._write({
+            "name": name, "cat": self.process_name, "ph": "X",
+            "ts": int(start * 1e6), "dur": max(int((end - start) * 1e6), 1),
+            "pid": self.pid, "tid": threading.get_ident(), "args": args
+        })
+
+    @contextmanager
+    def span(self, name: str, trace_id: Optional[str], **args):
+        """with文の区間をスパンとして記録"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.complete(name, trace_id, start, time.time(), **args)
+
+    def flow(self, trace_id: Optional[str], start: bool, ts: Optional[float] = None):
+        """クライアント送信とサーバー受信を矢印で結ぶフローイベントを記録"""
+        if trace_id is None or self.path is None:
+            return
+        event = {
+            "name": "command", "cat": "flow", "ph": "s" if start else "f",
+            "id": trace_id, "ts": int((ts if ts is not None else time.time()) * 1e6),
+            "pid": self.pid, "tid": threading.get_ident()
+        }
+        if not start:
+            event["bp"] = "e"
+        self._write(event)
+
+    def close(self):
+        """トレースファイルを閉じる"""
+        with self._lock:
+            if self._file is not None:
+                self._file.write(json.dumps({
+                    "name": "trace_end", "ph": "i", "s": "p",
+                    "ts": int(time.time() * 1e6), "pid": self.pid, "tid": 0
+                }) + "\n]\n")
+                self._file.close()
+                self._file = None
+
+
+def load_trace(path: str) -> List[Dict]:
+    """トレースファイルを読み込む（途中で終了し ] が無いファイルも読める）"""
+    with open(path, encoding='utf-8') as f:
+        text = f.read().strip()
+    if text.endswith(']'):
+        text = text[:-1].rstrip()
+    return json.loads(text.rstrip(',') + ']')
+
+
+def merge_traces(paths: Sequence[str], output: str) -> int:
+    """
+    クライアントとサーバーのトレースを1ファイルにまとめる
+    フローイベント（送信→受信の矢印）は両プロセスのイベントが同じファイルにあるときだけ結ばれる
+    """
+    events = []
+    for path in paths:
+        events.extend(load_trace(path))
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f, ensure_ascii=False)
+    return len(events)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='トレースファイル結合ツール（Perfetto / chrome://tracing 用）')
+    parser.add_argument('inputs', nargs='+', help='結合するトレースファイル（クライアント・サーバー）')
+    parser.add_argument('--output', '-o', default='merged_trace.json', help='出力ファイル')
+
+    args = parser.parse_args()
+
+    count = merge_traces(args.inputs, args.output)
+    print(f"✓ {len(args.inputs)}ファイル {count}イベントを結合しました: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,315 @@
+import argparse
+import hashlib
+import json
+import os
+import socket
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+from esp32_rtt import RttEstimator, drain_socket
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+SSE_KEEPALIVE = 15.0  # 秒
+API_TIMEOUT = 60.0    # LLM APIの応答待ち（秒）
+
+
+class StateHub:
+    """
+    最新状態をブラウザ全体に配信するハブ
+    イベントごとに最新値だけを保持するため、遅いクライアントは途中の値を飛ばして最新値を受け取る
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._version = 0
+        self._latest: Dict[str, Tuple[int, str]] = {}
+        self.subscribers = 0
+
+    def publish(self, event: str, payload):
+        """状態を更新（前回と同じ値なら配信しない）"""
+        data = json.dumps(payload)
+        with self._cond:
+            if event in self._latest and self._latest[event][1] == data:
+                return
+            self._version += 1
+            self._latest[event] = (self._version, data)
+            self._cond.notify_all()
+
+    def subscribe(self):
+        with self._cond:
+            self.subscribers += 1
+
+    def unsubscribe(self):
+        with self._cond:
+            self.subscribers -= 1
+
+    def latest(self, event: str) -> Optional[str]:
+        with self._cond:
+            entry = self._latest.get(event)
+            return entry[1] if entry else None
+
+    def wait(self, seen: int, timeout: float) -> Tuple[int, List[Tuple[str, str]]]:
+        """seen より新しい更新を待つ（タイムアウト時は空リスト）"""
+        with self._cond:
+            self._cond.wait_for(lambda: self._version > seen, timeout)
+            updates = [(event, data) for event, (version, data) in self._latest.items() if version > seen]
+            return self._version, updates
+
+
+class JointStatePoller:
+    """モックサーバー（または実機）の関節角度を1本のUDPストリームで取得しハブに流す"""
+
+    def __init__(self, hub: StateHub, robot_host: str, robot_port: int, interval: float):
+        self.hub = hub
+        self.addr = (robot_host, robot_port)
+        self.interval = interval
+        self.rtt = RttEstimator(initial_rto=0.5, min_rto=0.01, max_rto=0.5)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.running = False
+
+    def _poll_once(self) -> Optional[List[float]]:
+        drain_socket(self.sock)
+        self.sock.settimeout(self.rtt.rto)
+        sent_at = time.perf_counter()
+        self.sock.sendto(b"GET_JOINT_ANGLES", self.addr)
+        self.rtt.on_send()
+        try:
+            data, _ = self.sock.recvfrom(1024)
+        except socket.timeout:
+            self.rtt.on_timeout()
+            return None
+        self.rtt.on_reply(time.perf_counter() - sent_at)
+        return [float(a) for a in data.decode('utf-8').split(',')]
+
+    def run(self):
+        self.running = True
+        while self.running:
+            start = time.time()
+            try:
+                angles = self._poll_once()
+                if angles is not None:
+                    self.hub.publish('joints', {'to': angles})
+            except (OSError, ValueError) as e:
+                print(f"[関節] 取得エラー: {e}")
+            time.sleep(max(self.interval - (time.time() - start), 0))
+
+    def stop(self):
+        self.running = False
+        self.sock.close()
+
+
+class CameraCache:
+    """
+    カメラ画像のキャッシュ
+    上流への取得は同時に1本だけ行い（取得中の他リクエストは完了を待つ）、ETagで条件付きGETに応答する
+    """
+
+    def __init__(self, url: Optional[str], max_age: float):
+        self.url = url
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self.frame: Optional[bytes] = None
+        self.etag: Optional[str] = None
+        self.content_type = 'image/jpeg'
+        self.fetched_at = 0.0
+
+    def get(self) -> Tuple[Optional[bytes], Optional[str], str]:
+        """キャッシュが古ければ更新して (画像, ETag, Content-Type) を返す"""
+        if self.url is None:
+            return None, None, self.content_type
+        with self._lock:
+            if self.frame is None or time.time() - self.fetched_at >= self.max_age:
+                try:
+                    with urllib.request.urlopen(self.url, timeout=2) as response:
+                        frame = response.read()
+                        self.content_type = response.headers.get('Content-Type', self.content_type)
+                    if frame != self.frame:
+                        self.frame = frame
+                        self.etag = '"' + hashlib.sha1(frame).hexdigest()[:16] + '"'
+                except OSError as e:
+                    print(f"[カメラ] 取得エラー: {e}")
+                self.fetched_at = time.time()
+            return self.frame, self.etag, self.content_type
+
+
+class RobotWebHandler(BaseHTTPRequestHandler):
+    """Web UI 用のHTTPハンドラ"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass  # SSEの長時間接続でログが溢れるため出力しない
+
+    def _send_body(self, status: int, body: bytes, content_type: str, headers: Optional[Dict] = None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path in ('/', '/index.html'):
+            with open(os.path.join(STATIC_DIR, 'index.html'), 'rb') as f:
+                self._send_body(200, f.read(), 'text/html; charset=utf-8')
+        elif path == '/api/events':
+            self._stream_events()
+        elif path == '/api/joint_values':
+            data = self.server.hub.latest('joints') or json.dumps({'to': None})
+            self._send_body(200, data.encode('utf-8'), 'application/json', {'Cache-Control': 'no-cache'})
+        elif path == '/api/camera':
+            self._send_camera()
+        else:
+            self._send_body(404, b'Not Found', 'text/plain')
+
+    def do_HEAD(self):
+        """GETと同じヘッダーを本文なしで返す（_send_body が本文を省く）"""
+        self.do_GET()
+
+    def do_POST(self):
+        """LLM・承認API（/api/llm_order など）は --api-url の上流バックエンドへ転送する"""
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length) if length > 0 else b''
+        api_url = self.server.api_url
+        if api_url is None:
+            self._send_json(501, {'error': f'{self.path} は --api-url 指定時のみ利用できます'})
+            return
+        request = urllib.request.Request(api_url.rstrip('/') + self.path, data=body, method='POST')
+        if 'Content-Type' in self.headers:
+            request.add_header('Content-Type', self.headers['Content-Type'])
+        try:
+            with urllib.request.urlopen(request, timeout=API_TIMEOUT) as response:
+                status = response.status
+                data = response.read()
+                content_type = response.headers.get('Content-Type', 'application/json')
+        except urllib.error.HTTPError as e:
+            status, data = e.code, e.read()
+            content_type = e.headers.get('Content-Type', 'application/json')
+        except OSError as e:
+            print(f"[API] 転送エラー: {e}")
+            self._send_json(502, {'error': f'上流APIに接続できません: {e}'})
+            return
+        self._send_body(status, data, content_type)
+
+    def _send_json(self, status: int, payload: Dict):
+        self._send_body(status, json.dumps(payload, ensure_ascii=False).encode('utf-8'),
+                        'application/json; charset=utf-8')
+
+    def _send_camera(self):
+        frame, etag, content_type = self.server.camera.get()
+        if frame is None:
+            self._send_body(404, b'No camera frame', 'text/plain')
+            return
+        headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.end_headers()
+            return
+        self._send_body(200, frame, content_type, headers)
+
+    def _stream_events(self):
+        """Server-Sent Events でハブの更新を配信"""
+        hub = self.server.hub
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'keep-alive')
+        self.end_headers()
+        self.close_connection = True
+        if self.command == 'HEAD':
+            return
+
+        hub.subscribe()
+        seen = 0
+        try:
+            while self.server.running:
+                seen, updates = hub.wait(seen, SSE_KEEPALIVE)
+                if updates:
+                    chunk = ''.join(f"event: {event}\ndata: {data}\n\n" for event, data in updates)
+                else:
+                    chunk = ": keepalive\n\n"
+                self.wfile.write(chunk.encode('utf-8'))
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            hub.unsubscribe()
+
+
+class RobotWebServer(ThreadingHTTPServer):
+    """Web UI バックエンド（関節角度の配信とカメラ画像のキャッシュ）"""
+
+    daemon_threads = True
+
+    def __init__(self, host: str, port: int, robot_host: str, robot_port: int,
+                 joint_interval: float = 0.05, camera_url: Optional[str] = None,
+                 camera_interval: float = 1.0, api_url: Optional[str] = None):
+        super().__init__((host, port), RobotWebHandler)
+        self.api_url = api_url
+        self.hub = StateHub()
+        self.poller = JointStatePoller(self.hub, robot_host, robot_port, joint_interval)
+        self.camera = CameraCache(camera_url, camera_interval)
+        self.camera_interval = camera_interval
+        self.running = False
+
+    def _camera_loop(self):
+        """閲覧者がいる間だけカメラを更新し、新しい画像のETagを配信"""
+        while self.running:
+            if self.hub.subscribers > 0:
+                _, etag, _ = self.camera.get()
+                if etag is not None:
+                    self.hub.publish('camera', {'etag': etag.strip('"')})
+            time.sleep(self.camera_interval)
+
+    def start(self):
+        self.running = True
+        threading.Thread(target=self.poller.run, daemon=True).start()
+        if self.camera.url is not None:
+            threading.Thread(target=self._camera_loop, daemon=True).start()
+
+        host, port = self.server_address[:2]
+        print(f"Web UI バックエンド起動: http://{host}:{port}/")
+        print(f"ロボット: {self.poller.addr[0]}:{self.poller.addr[1]}")
+        print(f"カメラ: {self.camera.url or 'なし'}")
+        print(f"API転送先: {self.api_url or 'なし'}")
+        print("-" * 50)
+        try:
+            self.serve_forever()
+        except KeyboardInterrupt:
+            print("\n\nサーバーを終了します...")
+        finally:
+            self.running = False
+            self.poller.stop()
+            self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ロボットアーム Web UI バックエンド')
+    parser.add_argument('--host', default='127.0.0.1', help='HTTPのホストアドレス')
+    parser.add_argument('--port', type=int, default=8000, help='HTTPポート')
+    parser.add_argument('--robot-host', default='127.0.0.1', help='モックサーバー（実機）のアドレス')
+    parser.add_argument('--robot-port', type=int, default=4210, help='モックサーバー（実機）のUDPポート')
+    parser.add_argument('--interval', type=float, default=0.05, help='関節角度の取得間隔（秒）')
+    parser.add_argument('--camera-url', help='カメラ画像の取得元URL')
+    parser.add_argument('--camera-interval', type=float, default=1.0, help='カメラ画像の更新間隔（秒）')
+    parser.add_argument('--api-url', help='LLM・承認API（POST /api/...）の転送先バックエンドURL')
+
+    args = parser.parse_args()
+
+    server = RobotWebServer(args.host, args.port, args.robot_host, args.robot_port,
+                            joint_interval=args.interval, camera_url=args.camera_url,
+                            camera_interval=args.camera_interval, api_url=args.api_url)
+    server.start()
+
+
+if __name__ == "__main__":
+    main()